@@ -1,11 +1,22 @@
+import asyncio
+import hashlib
+import json
 import os
+import queue
+import re
 import sqlite3
-from datetime import datetime
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 
-from telegram import Update
+import sqlite_vec
+import tiktoken
+
+from telegram import Message, Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # ---------- CONFIG ----------
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -16,10 +27,29 @@ if not TELEGRAM_BOT_TOKEN:
 if not OPENAI_API_KEY:
     raise RuntimeError("Missing OPENAI_API_KEY env var")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# один токенайзер на весь процесс: загрузка словаря дорогая
+_ENC = tiktoken.encoding_for_model("gpt-4o-mini")
 
 DB_PATH = "/var/data/memory.sqlite"
 SHORT_HISTORY_LIMIT = 20  # последних сообщений на пользователя
+PROMPT_HISTORY_LIMIT = 12  # из них дословно в промпт (6 пар вопрос-ответ)
+RECALL_LIMIT = 4  # сколько похожих старых сообщений подмешивать из msg_vec
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+PROMPT_TOKEN_BUDGET = 2000  # токенов на facts + recall + историю, дальше обрезаем старое
+RECALL_TOKEN_BUDGET = 600  # из них не больше столько на блок «Из прошлых разговоров»
+FACTS_TOKEN_LIMIT = 800  # если facts длиннее — просим extractor их сжать
+MAX_OUTPUT_TOKENS = 800  # потолок длины ответа — ограничивает и время генерации
+STREAM_EDIT_INTERVAL = 1.0  # сек между правками сообщения при стриминге
+STREAM_EDIT_CHARS = 90  # или раньше, если набежало столько новых символов
+TELEGRAM_CHUNK = 4000  # Telegram режет сообщения длиннее 4096 символов
+EXTRACTOR_BATCH_INTERVAL = 15 * 60  # сек: как часто отправляем extractor в Batch API
+BATCH_POLL_INTERVAL = 60  # сек: как часто проверяем готовность batch'ей
+MAX_CONCURRENT_REPLIES = 32  # одновременных генераций на весь бот
+COALESCE_WINDOW = 0.8  # сек: ждём, не допишет ли человек ещё что-то
+ERROR_TEXT = "Ой, что-то пошло не так 🙏 Попробуй написать ещё раз чуть позже."
 
 SYSTEM_PROMPT = """
 Ты — «Душа», тёплый, бережный, мудрый проводник и наставница.
@@ -39,149 +69,724 @@ SYSTEM_PROMPT = """
 """
 
 # ---------- DB ----------
+READ_POOL_SIZE = 4  # read-only соединений для параллельного чтения
+TRIM_EVERY = 40  # подчищаем историю раз в столько строк диалога (20 пар)
+EXTRACT_EVERY = 12  # обновляем facts раз в столько строк диалога (6 пар)
+WRITE_FLUSH_INTERVAL = 0.1  # сек: как часто сбрасываем буфер сообщений в базу
+WRITE_FLUSH_ROWS = 50  # или раньше, если в буфере набралось столько строк
+OPTIMIZE_INTERVAL = 60 * 60  # сек: как часто гоняем PRAGMA optimize
+
+# одно RW-соединение на весь процесс (создаётся в init_db) + пул read-only
+_CONN: sqlite3.Connection | None = None
+_WRITE_LOCK = threading.Lock()
+_READ_POOL: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+
+# удалось ли загрузить sqlite-vec (см. init_db); без него живём без recall
+_VEC_ENABLED = False
+
+# messages.role храним числом: так строки и индекс компактнее
+_ROLE = {"user": 0, "assistant": 1, "system": 2}
+_ROLE_NAME = {v: k for k, v in _ROLE.items()}
+
+# сообщения ждут записи здесь и уходят в базу пачкой (см. _message_writer)
+_WRITE_BUFFER: list[tuple[int, str, str]] = []
+_TRIM_PENDING: set[int] = set()
+_FLUSH_NOW = asyncio.Event()
+# сбросы идут строго по одному, иначе пачки могут лечь в базу не по порядку
+_FLUSH_LOCK = asyncio.Lock()
+
+# batch_id -> пользователи в нём; пока batch не вернулся, новых строк
+# для этих пользователей не шлём (хранится и в extractor_batches)
+_BATCH_USERS: dict[str, set[int]] = {}
+
+# кому уже заказано сжатие facts (чтобы не заказывать на каждом сообщении)
+_COMPACT_REQUESTED: set[int] = set()
+
+# facts меняются редко — держим их в памяти процесса целиком: заполняется
+# в init_db, дальше меняется только через set_facts
+_FACTS_CACHE: dict[int, str] = {}
+# сколько строк диалога (пользователь + ассистент) записано с момента запуска
+_COUNT_CACHE: dict[int, int] = {}
+
+def _connect(uri: str | None = None) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        uri or DB_PATH,
+        uri=uri is not None,
+        check_same_thread=False,
+        isolation_level=None,  # autocommit, транзакции открываем сами
+    )
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")  # читаем файл через mmap, без pread на каждый запрос
+    return conn
+
+def _load_vec(conn: sqlite3.Connection) -> bool:
+    # не во всех сборках Python sqlite3 умеет грузить расширения
+    try:
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+    except (AttributeError, sqlite3.Error):
+        return False
+    return True
+
+@contextmanager
+def _writer():
+    """Одна транзакция на общем RW-соединении."""
+    with _WRITE_LOCK:
+        cur = _CONN.cursor()
+        cur.execute("BEGIN")
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+
+@contextmanager
+def _reader():
+    """Берём read-only соединение из пула и возвращаем его обратно."""
+    conn = _READ_POOL.get()
+    try:
+        yield conn.cursor()
+    finally:
+        # если запрос упал посреди BEGIN, не отдаём в пул открытую транзакцию
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        _READ_POOL.put(conn)
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    global _CONN, _VEC_ENABLED
+    _CONN = _connect()
+    _VEC_ENABLED = _load_vec(_CONN)
+    cur = _CONN.cursor()
+
+    # WAL пишется в сам файл базы, поэтому достаточно выставить один раз
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+
+    # старые базы (role TEXT, facts с rowid) перекладываем в новую схему
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name IN ('facts', 'messages')")
+    old = dict(cur.fetchall())
+    migrate_facts = "facts" in old and "WITHOUT ROWID" not in old["facts"].upper()
+    migrate_messages = "messages" in old and "role INTEGER" not in old["messages"]
+
+    cur.execute("BEGIN")
+    if migrate_facts:
+        cur.execute("ALTER TABLE facts RENAME TO facts_old")
+    if migrate_messages:
+        cur.execute("ALTER TABLE messages RENAME TO messages_old")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS facts (
         user_id INTEGER PRIMARY KEY,
         facts TEXT DEFAULT ''
-    )
+    ) WITHOUT ROWID
     """)
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
-        role TEXT,
+        role INTEGER,
         content TEXT,
-        ts TEXT
+        ts TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
     )
     """)
 
-    conn.commit()
-    conn.close()
+    if migrate_facts:
+        cur.execute("INSERT INTO facts(user_id, facts) SELECT user_id, facts FROM facts_old")
+        cur.execute("DROP TABLE facts_old")
+    if migrate_messages:
+        cur.execute("""
+        INSERT INTO messages(id, user_id, role, content, ts)
+        SELECT id, user_id,
+               CASE role WHEN 'user' THEN 0 WHEN 'assistant' THEN 1 ELSE 2 END,
+               content, ts
+        FROM messages_old
+        """)
+        cur.execute("DROP TABLE messages_old")
+    cur.execute("COMMIT")
+
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_messages_user_id ON messages(user_id, id DESC)")
+
+    # эмбеддинги всей переписки (messages подчищается, а здесь живёт всё)
+    if _VEC_ENABLED:
+        cur.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS msg_vec USING vec0(
+            user_id INTEGER PARTITION KEY,
+            embedding float[{EMBEDDING_DIM}] distance_metric=cosine,
+            +role TEXT,
+            +content TEXT
+        )
+        """)
+
+    # batch'и extractor'а, которые ещё не вернулись (переживают рестарт)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS extractor_batches (
+        id TEXT PRIMARY KEY,
+        user_ids TEXT DEFAULT ''
+    )
+    """)
+    cur.execute("PRAGMA table_info(extractor_batches)")
+    if "user_ids" not in {row[1] for row in cur.fetchall()}:
+        cur.execute("ALTER TABLE extractor_batches ADD COLUMN user_ids TEXT DEFAULT ''")
+    cur.execute("SELECT id, user_ids FROM extractor_batches")
+    for batch_id, user_ids in cur.fetchall():
+        _BATCH_USERS[batch_id] = {int(u) for u in user_ids.split(",") if u}
+
+    cur.execute("SELECT user_id, facts FROM facts")
+    _FACTS_CACHE.update(cur.fetchall())
+
+    for _ in range(READ_POOL_SIZE):
+        conn = _connect(f"file:{DB_PATH}?mode=ro")
+        if _VEC_ENABLED:
+            _load_vec(conn)
+        _READ_POOL.put(conn)
 
 def get_facts(user_id: int) -> str:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT facts FROM facts WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else ""
+    # нет в кэше — значит, и в базе нет
+    return _FACTS_CACHE.get(user_id) or ""
 
-def set_facts(user_id: int, facts: str):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
+def facts_hash(facts: str) -> str:
+    return hashlib.sha1(facts.encode()).hexdigest()[:12]
+
+def _store_facts(user_id: int, facts: str):
+    # вызывать под _WRITE_LOCK
+    _CONN.execute("""
     INSERT INTO facts(user_id, facts) VALUES(?, ?)
     ON CONFLICT(user_id) DO UPDATE SET facts=excluded.facts
     """, (user_id, facts))
-    conn.commit()
-    conn.close()
-
-def add_message(user_id: int, role: str, content: str):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO messages(user_id, role, content, ts) VALUES(?,?,?,?)",
-        (user_id, role, content, datetime.utcnow().isoformat())
-    )
-    conn.commit()
-    conn.close()
+    _FACTS_CACHE[user_id] = facts
+    _COMPACT_REQUESTED.discard(user_id)
 
-def get_recent_messages(user_id: int, limit: int = SHORT_HISTORY_LIMIT):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-    SELECT role, content FROM messages
+def set_facts(user_id: int, facts: str):
+    with _WRITE_LOCK:
+        _store_facts(user_id, facts)
+
+def append_fact(user_id: int, fact: str):
+    """Дописываем факт в конец facts (чтение и запись под одной блокировкой)."""
+    with _WRITE_LOCK:
+        current = get_facts(user_id).strip()
+        _store_facts(user_id, (current + "\n" + fact).strip() if current else fact)
+
+def replace_facts(user_id: int, based_on: str, facts: str) -> bool:
+    """
+    set_facts, но только если facts с тех пор не менялись
+    (based_on — facts_hash того, из чего считали новые). True — записали.
+    """
+    with _WRITE_LOCK:
+        if facts_hash(get_facts(user_id)) != based_on:
+            return False
+        _store_facts(user_id, facts)
+        return True
+
+_INSERT_MESSAGE_SQL = "INSERT INTO messages(user_id, role, content) VALUES(?,?,?)"
+
+def _insert_messages(cur: sqlite3.Cursor, rows: list[tuple[int, str, str]]):
+    """rows — (user_id, role, content); ts проставляет SQLite."""
+    cur.executemany(_INSERT_MESSAGE_SQL, [(u, _ROLE[role], c) for (u, role, c) in rows])
+
+_RECENT_SQL = """
+SELECT role, content FROM messages
+WHERE user_id=?
+ORDER BY id DESC
+LIMIT ?
+"""
+
+_TRIM_SQL = """
+DELETE FROM messages
+WHERE user_id=? AND id <= (
+    SELECT id FROM messages
     WHERE user_id=?
     ORDER BY id DESC
-    LIMIT ?
-    """, (user_id, limit))
-    rows = cur.fetchall()
-    conn.close()
-    # возвращаем в правильном порядке
-    return [{"role": r, "content": c} for (r, c) in reversed(rows)]
-
-def trim_history(user_id: int, keep: int = SHORT_HISTORY_LIMIT):
-    """Оставляем только последние keep сообщений, чтобы база не раздувалась."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-    DELETE FROM messages
-    WHERE user_id=? AND id NOT IN (
-        SELECT id FROM messages
-        WHERE user_id=?
-        ORDER BY id DESC
-        LIMIT ?
-    )
-    """, (user_id, user_id, keep))
-    conn.commit()
-    conn.close()
+    LIMIT 1 OFFSET ?
+)
+"""
+
+def add_message(user_id: int, role: str, content: str, trim: bool = False):
+    """
+    Кладём сообщение в буфер, в базу его запишет _message_writer.
+    Вызывать только из event loop. trim — заодно подчистить историю.
+    """
+    _WRITE_BUFFER.append((user_id, role, content))
+    if trim:
+        _TRIM_PENDING.add(user_id)
+    if len(_WRITE_BUFFER) >= WRITE_FLUSH_ROWS:
+        _FLUSH_NOW.set()
+
+def load_context(user_id: int, limit: int = PROMPT_HISTORY_LIMIT, query_vec: list[float] | None = None):
+    """
+    facts (из кэша) + последние limit сообщений одним снимком базы.
+    Если передан query_vec — ещё и до RECALL_LIMIT похожих старых сообщений.
+    """
+    facts = get_facts(user_id)
+    recalled = []
+    with _reader() as cur:
+        cur.execute("BEGIN")
+        cur.execute(_RECENT_SQL, (user_id, limit))
+        rows = cur.fetchall()
+        if query_vec is not None and _VEC_ENABLED:
+            # берём с запасом: свежие сообщения и так будут в промпте дословно
+            cur.execute("""
+            SELECT role, content FROM msg_vec
+            WHERE embedding MATCH ? AND k = ? AND user_id = ?
+            ORDER BY distance
+            """, (sqlite_vec.serialize_float32(query_vec), RECALL_LIMIT + limit, user_id))
+            recent = {c for (_, c) in rows}
+            recalled = [(r, c) for (r, c) in cur.fetchall() if c not in recent][:RECALL_LIMIT]
+        cur.execute("COMMIT")
+    history = [{"role": _ROLE_NAME[r], "content": c} for (r, c) in reversed(rows)]
+    return facts, history, recalled
+
+def add_embeddings(user_id: int, rows: list[tuple[str, str, list[float]]]):
+    """rows — (role, content, embedding)."""
+    with _writer() as cur:
+        cur.executemany(
+            "INSERT INTO msg_vec(user_id, embedding, role, content) VALUES(?,?,?,?)",
+            [(user_id, sqlite_vec.serialize_float32(vec), role, content) for (role, content, vec) in rows],
+        )
+
+def forget_embeddings(user_id: int):
+    """Удаляем всю переписку пользователя из msg_vec, чтобы recall её не поднимал."""
+    if not _VEC_ENABLED:
+        return
+    with _WRITE_LOCK:
+        _CONN.execute("DELETE FROM msg_vec WHERE user_id=?", (user_id,))
+
+def add_batch(batch_id: str, user_ids: set[int]):
+    with _WRITE_LOCK:
+        _CONN.execute(
+            "INSERT OR IGNORE INTO extractor_batches(id, user_ids) VALUES(?, ?)",
+            (batch_id, ",".join(map(str, user_ids))),
+        )
+        _BATCH_USERS[batch_id] = set(user_ids)
+
+def get_batches() -> list[str]:
+    with _reader() as cur:
+        cur.execute("SELECT id FROM extractor_batches")
+        return [r[0] for r in cur.fetchall()]
+
+def remove_batch(batch_id: str):
+    with _WRITE_LOCK:
+        _CONN.execute("DELETE FROM extractor_batches WHERE id=?", (batch_id,))
+
+def optimize_db():
+    # PRAGMA optimize смотрит на запросы, которые выполнило это соединение,
+    # поэтому на свежем соединении он бесполезен — зовём периодически и на выходе
+    with _WRITE_LOCK:
+        _CONN.execute("PRAGMA optimize")
+
+def write_messages(rows: list[tuple[int, str, str]], trim_users: set[int]):
+    """Пачка сообщений и подчистка истории — одной транзакцией."""
+    with _writer() as cur:
+        _insert_messages(cur, rows)
+        for user_id in trim_users:
+            cur.execute(_TRIM_SQL, (user_id, user_id, SHORT_HISTORY_LIMIT))
 
 # ---------- AI ----------
-def build_messages(user_id: int, user_text: str):
-    facts = get_facts(user_id).strip()
+def count_tokens(text: str) -> int:
+    return len(_ENC.encode(text))
 
-    memory_block = ""
+def build_messages(user_id: int, user_text: str, query_vec: list[float] | None = None):
+    """
+    Возвращает (messages, нужно_ли_сжать_facts).
+    В PROMPT_TOKEN_BUDGET укладываем facts, затем похожие старые реплики
+    (не больше RECALL_TOKEN_BUDGET), а остаток — история с конца.
+    """
+    facts, history, recalled = load_context(user_id, PROMPT_HISTORY_LIMIT, query_vec)
+    facts = facts.strip()
+
+    facts_tokens = count_tokens(facts)
+    budget = PROMPT_TOKEN_BUDGET - facts_tokens
+
+    recall_budget = min(RECALL_TOKEN_BUDGET, budget)
+    kept_recall = []
+    for r, c in recalled:
+        cost = count_tokens(c)
+        if cost > recall_budget:
+            continue  # длинную реплику пропускаем, короче может и влезть
+        recall_budget -= cost
+        budget -= cost
+        kept_recall.append((r, c))
+    recalled = kept_recall
+
+    kept = []
+    for m in reversed(history):
+        budget -= count_tokens(m["content"])
+        if budget < 0:
+            break
+        kept.append(m)
+    history = kept[::-1]
+
+    compact = facts_tokens > FACTS_TOKEN_LIMIT and user_id not in _COMPACT_REQUESTED
+
+    # SYSTEM_PROMPT уходит в instructions и всегда один и тот же, чтобы
+    # OpenAI переиспользовал кэш промпта; facts идут отдельным сообщением
+    msgs = []
     if facts:
-        memory_block = f"\n\nДолгая память (facts) о пользователе:\n{facts}\n"
-
-    msgs = [{"role": "system", "content": SYSTEM_PROMPT + memory_block}]
-    msgs += get_recent_messages(user_id, SHORT_HISTORY_LIMIT)
+        msgs += [{"role": "system", "content": f"Долгая память (facts) о пользователе:\n{facts}"}]
+    if recalled:
+        # старые реплики по теме — отдельным блоком, чтобы не путать порядок диалога
+        lines = [f"{'Пользователь' if r == 'user' else 'Ассистент'}: {c}" for (r, c) in recalled]
+        msgs += [{"role": "system", "content": "Из прошлых разговоров:\n" + "\n".join(lines)}]
+    msgs += history
     msgs += [{"role": "user", "content": user_text}]
-    return msgs
-
-def ask_ai(user_id: int, user_text: str) -> str:
-    messages = build_messages(user_id, user_text)
-
-    resp = client.chat.completions.create(
+    return msgs, compact
+
+async def embed(texts: list[str]) -> list[list[float]]:
+    resp = await client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+    return [d.embedding for d in resp.data]
+
+async def ask_ai(user_id: int, user_text: str, query_vec: list[float] | None = None):
+    """Стримим ответ: отдаём куски текста по мере генерации."""
+    messages, compact = await asyncio.to_thread(build_messages, user_id, user_text, query_vec)
+    if compact:
+        # facts разрослись — пусть extractor их сожмёт (без новых сообщений)
+        _COMPACT_REQUESTED.add(user_id)
+        _extractor_queue.put_nowait((user_id, None, None))
+
+    # историю храним сами (SQLite), поэтому на стороне OpenAI ничего не сохраняем
+    stream = await client.responses.create(
         model="gpt-4.1-mini",
-        messages=messages,
+        instructions=SYSTEM_PROMPT,
+        input=messages,
         temperature=0.7,
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        store=False,
+        stream=True,
     )
-    return resp.choices[0].message.content.strip()
-
-def update_facts_with_ai(user_id: int, user_text: str, assistant_text: str):
+    async for event in stream:
+        if event.type == "response.output_text.delta" and event.delta:
+            yield event.delta
+        elif event.type == "response.failed":
+            error = event.response.error
+            raise RuntimeError(f"response failed: {error.message if error else 'unknown error'}")
+        elif event.type == "error":
+            raise RuntimeError(f"response stream error: {event.message}")
+
+def extractor_request(user_id: int, turns: list[tuple[str, str]]) -> dict:
     """
     Мягкое обновление фактов: извлекаем только устойчивые предпочтения/данные.
     Запускается НЕ каждый раз (см. ниже), чтобы экономить.
+    turns — пары (реплика пользователя, ответ ассистента), может быть пустым,
+    если нужно только сжать разросшиеся facts.
+    Возвращает строку запроса для Batch API.
     """
     current_facts = get_facts(user_id)
 
+    new_messages = "\n".join(
+        f"Пользователь: {user_text}\nАссистент: {assistant_text}"
+        for user_text, assistant_text in turns
+    ) or "(нет)"
+    compact_rule = ""
+    if count_tokens(current_facts) > FACTS_TOKEN_LIMIT:
+        compact_rule = "\n- facts слишком длинные: объедини похожие пункты, убери устаревшие, оставь самое важное."
     extractor_prompt = f"""
 Ты извлекатель фактов для долгой памяти.
 Твоя задача: обновить "facts" о пользователе кратко и полезно.
 Правила:
 - добавляй только устойчивые вещи: имя, предпочтения, цели, важные долгосрочные проекты;
 - НЕ добавляй секреты (ключи, пароли), номера карт, точные адреса;
-- НЕ добавляй одноразовые мелочи.
+- НЕ добавляй одноразовые мелочи.{compact_rule}
 Формат: короткие пункты, 1 строка = 1 факт.
 
 Текущие facts:
 {current_facts}
 
 Новые сообщения:
-Пользователь: {user_text}
-Ассистент: {assistant_text}
+{new_messages}
 
 Верни обновлённый список facts:
 """
 
-    resp = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        messages=[
-            {"role": "system", "content": "Ты аккуратный извлекатель фактов."},
-            {"role": "user", "content": extractor_prompt},
-        ],
-        temperature=0.2,
+    return {
+        # хэш исходных facts: результат придёт нескоро, и если за это время
+        # facts поменялись (/remember, /clear_memory), он уже устарел
+        "custom_id": f"facts-{user_id}-{facts_hash(current_facts)}",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": "gpt-4.1-mini",
+            "messages": [
+                {"role": "system", "content": "Ты аккуратный извлекатель фактов."},
+                {"role": "user", "content": extractor_prompt},
+            ],
+            "temperature": 0.2,
+        },
+    }
+
+async def submit_extractor_batch(pending: dict[int, list[tuple[str, str]]]):
+    """Отправляем накопленные запросы extractor'а одним batch'ем (в 2 раза дешевле)."""
+    lines = [await asyncio.to_thread(extractor_request, user_id, turns) for user_id, turns in pending.items()]
+    data = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines)
+
+    f = await client.files.create(file=("extractor.jsonl", data.encode()), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=f.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
     )
-    new_facts = resp.choices[0].message.content.strip()
-    set_facts(user_id, new_facts)
+    await asyncio.to_thread(add_batch, batch.id, set(pending))
+
+async def apply_extractor_batch(batch_id: str) -> bool:
+    """Забираем результат batch'а и обновляем facts. True — batch завершён."""
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status not in ("completed", "failed", "expired", "cancelled"):
+        return False
+
+    # у expired/cancelled может быть частичный результат
+    if batch.output_file_id:
+        content = await client.files.content(batch.output_file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                user_part, based_on = item["custom_id"].rsplit("-", 1)
+                user_id = int(user_part.removeprefix("facts-"))
+                new_facts = response["body"]["choices"][0]["message"]["content"].strip()
+                await asyncio.to_thread(replace_facts, user_id, based_on, new_facts)
+            except Exception:
+                continue  # отказ модели, content=None и т.п. — пропускаем строку
+
+    # кому facts так и не пришли — сжатие можно заказать заново
+    _COMPACT_REQUESTED.difference_update(_BATCH_USERS.pop(batch_id, ()))
+    return True
+
+# держим ссылки на фоновые задачи, иначе их может собрать GC
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+# (user_id, user_text, assistant_text) для extractor'а
+# user_text=None — запрос только на сжатие facts
+_extractor_queue: "asyncio.Queue[tuple[int, str | None, str | None]]" = asyncio.Queue()
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+async def flush_messages():
+    async with _FLUSH_LOCK:
+        if not _WRITE_BUFFER and not _TRIM_PENDING:
+            return
+        rows = _WRITE_BUFFER[:]
+        trims = set(_TRIM_PENDING)
+        _WRITE_BUFFER.clear()
+        _TRIM_PENDING.clear()
+        try:
+            await asyncio.to_thread(write_messages, rows, trims)
+        except Exception:
+            # вернём в начало буфера и попробуем на следующем сбросе
+            _WRITE_BUFFER[:0] = rows
+            _TRIM_PENDING.update(trims)
+            raise
+
+async def _message_writer():
+    """
+    Сбрасываем буфер раз в WRITE_FLUSH_INTERVAL сек или по WRITE_FLUSH_ROWS строк.
+    Заодно раз в OPTIMIZE_INTERVAL сек запускаем optimize_db.
+    """
+    loop = asyncio.get_running_loop()
+    next_optimize = loop.time() + OPTIMIZE_INTERVAL
+    while True:
+        try:
+            await asyncio.wait_for(_FLUSH_NOW.wait(), WRITE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _FLUSH_NOW.clear()
+        try:
+            await flush_messages()
+        except Exception:
+            pass  # данные остались в буфере
+
+        if loop.time() >= next_optimize:
+            next_optimize = loop.time() + OPTIMIZE_INTERVAL
+            try:
+                await asyncio.to_thread(optimize_db)
+            except Exception:
+                pass  # не критично, попробуем в следующий раз
+
+async def _extractor_worker():
+    """
+    Единственный фоновый обработчик очереди extractor'а.
+    Копим запросы EXTRACTOR_BATCH_INTERVAL сек; всё, что накопилось
+    по одному пользователю, уходит одной строкой batch'а.
+    Пользователей, чей прошлый batch ещё не вернулся, придерживаем до
+    следующего круга: их новый запрос считался бы от старых facts,
+    и replace_facts его бы отбросил.
+    """
+    def collect(item):
+        user_id, user_text, assistant_text = item
+        turns = pending.setdefault(user_id, [])
+        if user_text is not None:
+            turns.append((user_text, assistant_text))
+
+    loop = asyncio.get_running_loop()
+    held: dict[int, list[tuple[str, str]]] = {}
+    while True:
+        pending = held
+        if not pending:
+            collect(await _extractor_queue.get())
+
+        deadline = loop.time() + EXTRACTOR_BATCH_INTERVAL
+        while (left := deadline - loop.time()) > 0:
+            try:
+                collect(await asyncio.wait_for(_extractor_queue.get(), left))
+            except asyncio.TimeoutError:
+                break
+
+        in_flight = set().union(*_BATCH_USERS.values())
+        held = {u: t for u, t in pending.items() if u in in_flight}
+        ready = {u: t for u, t in pending.items() if u not in in_flight}
+        if not ready:
+            continue
+
+        try:
+            await submit_extractor_batch(ready)
+        except Exception:
+            # не падаем, если extractor не сработал; сжатие закажем заново
+            _COMPACT_REQUESTED.difference_update(ready)
+
+async def _batch_poller():
+    while True:
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        for batch_id in await asyncio.to_thread(get_batches):
+            try:
+                if await apply_extractor_batch(batch_id):
+                    await asyncio.to_thread(remove_batch, batch_id)
+            except Exception:
+                pass  # попробуем на следующем круге
+
+async def _remember_turn(user_id: int, user_text: str, user_vec: list[float] | None, assistant_text: str):
+    """Кладём эмбеддинги реплик в msg_vec (в фоне, после ответа)."""
+    try:
+        if user_vec is None:
+            user_vec, assistant_vec = await embed([user_text, assistant_text])
+        else:
+            (assistant_vec,) = await embed([assistant_text])
+        await asyncio.to_thread(add_embeddings, user_id, [
+            ("user", user_text, user_vec),
+            ("assistant", assistant_text, assistant_vec),
+        ])
+    except Exception:
+        pass  # без эмбеддинга просто не найдём эту реплику потом
 
 # ---------- Telegram handlers ----------
+# сообщения одного пользователя обрабатываем строго по очереди,
+# разных пользователей — параллельно (но не больше MAX_CONCURRENT_REPLIES)
+_USER_LOCKS: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+_GLOBAL_SEM = asyncio.Semaphore(MAX_CONCURRENT_REPLIES)
+# сообщения, которые пришли подряд и ещё ждут ответа
+_PENDING_TEXTS: dict[int, list[str]] = {}
+
+async def _edit_text(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, text: str):
+    while True:
+        try:
+            await context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+            return
+        except RetryAfter as e:
+            # упёрлись в лимиты Telegram — ждём сколько попросили
+            await asyncio.sleep(e.retry_after)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            raise
+
+def _chunks(s: str, n: int = TELEGRAM_CHUNK) -> list[str]:
+    """Режем текст на куски до n символов по абзацам, затем по предложениям."""
+    pieces = []
+    for para in re.split(r"(?<=\n)", s):
+        if len(para) <= n:
+            pieces.append(para)
+            continue
+        for sent in re.split(r"(?<=[.!?…] )", para):
+            pieces += [sent[i:i + n] for i in range(0, len(sent), n)]
+
+    parts, cur = [], ""
+    for piece in pieces:
+        if cur and len(cur) + len(piece) > n:
+            parts.append(cur)
+            cur = ""
+        cur += piece
+    if cur:
+        parts.append(cur)
+    return parts
+
+async def reply_long(update: Update, text: str):
+    """reply_text, который не падает на длинных ответах."""
+    first = True
+    for part in _chunks(text):
+        if not part.strip():
+            continue
+        if not first:
+            await asyncio.sleep(0.05)
+        await update.message.reply_text(part.strip())
+        first = False
+
+async def stream_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, deltas, placeholder: Message) -> str:
+    """
+    Правим уже отправленную заглушку по мере прихода текста:
+    раз в STREAM_EDIT_INTERVAL сек или каждые STREAM_EDIT_CHARS символов.
+    Если текст перерос TELEGRAM_CHUNK, дописываем его в новые сообщения.
+    Возвращаем итоговый текст. Если генерация упала — дописываем ERROR_TEXT
+    в то сообщение, которое правили последним, и пробрасываем ошибку.
+    """
+    chat_id, message_id = placeholder.chat_id, placeholder.message_id
+    loop = asyncio.get_running_loop()
+
+    done = ""  # текст, уже разложенный по предыдущим сообщениям
+    buf = ""  # текст текущего сообщения
+    shown = ""  # что сейчас видно в сообщении message_id
+    last_edit = loop.time()
+    try:
+        async for delta in deltas:
+            buf += delta
+            if len(buf) > TELEGRAM_CHUNK:
+                parts = _chunks(buf)
+                head, buf = parts[:-1], parts[-1]
+                if head[0].strip():
+                    await _edit_text(context, chat_id, message_id, head[0].strip())
+                    shown = head[0].strip()
+                for part in head[1:]:
+                    if part.strip():
+                        await asyncio.sleep(0.05)
+                        await update.message.reply_text(part.strip())
+                done += "".join(head)
+                msg = await update.message.reply_text(buf.strip() or "…")
+                chat_id, message_id = msg.chat_id, msg.message_id
+                shown = buf.strip()
+                last_edit = loop.time()
+                continue
+
+            now = loop.time()
+            if now - last_edit >= STREAM_EDIT_INTERVAL or len(buf) - len(shown) >= STREAM_EDIT_CHARS:
+                text = buf.strip()
+                if text and text != shown:
+                    await _edit_text(context, chat_id, message_id, text)
+                    shown = text
+                last_edit = loop.time()
+
+        # финальная правка, когда генерация закончилась
+        text = buf.strip()
+        if text and text != shown:
+            await _edit_text(context, chat_id, message_id, text)
+        # отказ или incomplete без текста — тоже ошибка, а не вечное «…»
+        if not (done + buf).strip():
+            raise RuntimeError("model returned an empty reply")
+    except Exception:
+        # показываем ошибку там, где человек сейчас смотрит, не затирая уже написанное
+        try:
+            await _edit_text(context, chat_id, message_id, f"{shown}\n\n{ERROR_TEXT}" if shown else ERROR_TEXT)
+        except Exception:
+            pass
+        raise
+    return (done + buf).strip()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     add_message(user_id, "assistant", "Привет, душа моя 🤍 Я здесь. Хочешь поговорить?")
@@ -198,51 +803,100 @@ async def remember(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Напиши после /remember что именно запомнить 🙏")
         return
 
-    current = get_facts(user_id).strip()
-    updated = (current + "\n" + text).strip() if current else text
-    set_facts(user_id, updated)
+    await asyncio.to_thread(append_fact, user_id, text)
     await update.message.reply_text("Запомнила 🤍")
 
 async def memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     facts = get_facts(user_id).strip()
-    await update.message.reply_text(f"Вот что я о тебе помню:\n\n{facts if facts else 'Пока пусто 🤍'}")
+    await reply_long(update, f"Вот что я о тебе помню:\n\n{facts if facts else 'Пока пусто 🤍'}")
 
 async def clear_memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    set_facts(user_id, "")
+    await asyncio.to_thread(set_facts, user_id, "")
+    await asyncio.to_thread(forget_embeddings, user_id)
     await update.message.reply_text("Очистила долгую память 🤍")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_text = update.message.text.strip()
 
-    # сохраняем сообщение пользователя
-    add_message(user_id, "user", user_text)
-
-    # получаем ответ
-    assistant_text = ask_ai(user_id, user_text)
-
-    # сохраняем ответ ассистента
-    add_message(user_id, "assistant", assistant_text)
-
-    # подчищаем историю
-    trim_history(user_id, SHORT_HISTORY_LIMIT)
-
-    # обновлять факты не каждый раз: например, 1 раз в 6 сообщений
-    # (чтобы экономить и не грузить)
-    count = len(get_recent_messages(user_id, SHORT_HISTORY_LIMIT))
-    if count % 6 == 0:
+    # несколько быстрых сообщений подряд склеиваем в один запрос:
+    # дальше идёт только последнее, остальные просто выходят
+    pending = _PENDING_TEXTS.setdefault(user_id, [])
+    pending.append(user_text)
+    seen = len(pending)
+    await asyncio.sleep(COALESCE_WINDOW)
+    if _PENDING_TEXTS.get(user_id) is not pending or len(pending) != seen:
+        return
+    del _PENDING_TEXTS[user_id]
+    user_text = "\n".join(pending)
+
+    # заглушку шлём до очереди — человек видит, что его услышали
+    placeholder = await update.message.reply_text("…")
+
+    async with _USER_LOCKS[user_id], _GLOBAL_SEM:
+        # предыдущий ход этого пользователя мог ещё не доехать из буфера в базу,
+        # а историю для промпта мы читаем только из базы
+        if any(row[0] == user_id for row in _WRITE_BUFFER):
+            try:
+                await flush_messages()
+            except Exception:
+                pass  # ответим по той истории, что уже в базе
+
+        # эмбеддинг вопроса — для поиска похожих старых реплик
+        user_vec = None  # без него (или без sqlite-vec) ответим просто без recall
+        if _VEC_ENABLED:
+            try:
+                (user_vec,) = await embed([user_text])
+            except Exception:
+                pass
+
+        # получаем ответ и сразу показываем его по мере генерации
         try:
-            update_facts_with_ai(user_id, user_text, assistant_text)
+            deltas = ask_ai(user_id, user_text, user_vec)
+            assistant_text = await stream_reply(update, context, deltas, placeholder)
         except Exception:
-            pass  # не падаем, если extractor не сработал
-
-    await update.message.reply_text(assistant_text)
+            # ERROR_TEXT уже показал stream_reply; реплику пользователя не теряем
+            add_message(user_id, "user", user_text)
+            raise
+
+        # +2: реплика пользователя и ответ; историю заново не перечитываем
+        count = _COUNT_CACHE[user_id] = _COUNT_CACHE.get(user_id, 0) + 2
+
+        # обе реплики уходят в базу одной пачкой; историю подчищаем
+        # не каждый раз, а раз в TRIM_EVERY строк
+        add_message(user_id, "user", user_text)
+        add_message(user_id, "assistant", assistant_text, trim=count % TRIM_EVERY == 0)
+        if _VEC_ENABLED:
+            _spawn(_remember_turn(user_id, user_text, user_vec, assistant_text))
+
+        # обновлять факты не каждый раз: раз в EXTRACT_EVERY строк (6 сообщений)
+        # (чтобы экономить и не грузить); в фоне, чтобы не задерживать ответ
+        if count % EXTRACT_EVERY == 0:
+            _extractor_queue.put_nowait((user_id, user_text, assistant_text))
+
+async def post_init(app: Application):
+    _spawn(_message_writer())
+    _spawn(_extractor_worker())
+    _spawn(_batch_poller())
+
+async def post_shutdown(app: Application):
+    # дописываем то, что не успело уйти из буфера
+    await flush_messages()
+    await asyncio.to_thread(optimize_db)
 
 def main():
     init_db()
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # без concurrent_updates PTB обрабатывает апдейты строго по одному
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("remember", remember))